@@ -7,9 +7,15 @@ import shutil
 import tempfile
 import logging
 import argparse
+import functools
+import threading
+import Queue
+from collections import OrderedDict
 from ConfigParser import SafeConfigParser
 from dropbox import client
 import requests
+from requests.packages.urllib3.filepost import encode_multipart_formdata
+from cStringIO import StringIO
 import md5
 import json
 import time
@@ -19,7 +25,6 @@ from xml.dom import minidom
 
 logger = logging.getLogger(__name__)
 CONF_FILE = 'phosync.conf'
-TMP_DIR = ''
 SUPPORT_MIME_LIST = [
     'image/jpeg',
     'image/png',
@@ -27,6 +32,13 @@ SUPPORT_MIME_LIST = [
     'image/x-ms-bmp',
 ]
 IMAGE_SIZE_LIMIT = 10485760  # bytes == 10MB
+CHUNK_SIZE = 65536  # bytes == 64KB
+ORDER_SMALLEST = 'smallest'
+ORDER_LARGEST = 'largest'
+CACHE_DIR = tempfile.gettempdir() + os.sep + 'phosync' + os.sep + 'cache'
+CACHE_SIZE_LIMIT = 1073741824  # bytes == 1GB
+CACHE_TMP_AGE = 86400  # seconds == 1 day
+CACHE_SCAN_INTERVAL = 60  # seconds
 
 
 def retry(tries=3, delay=1):
@@ -85,6 +97,287 @@ def legal_image_size(size_string):
     return is_smaller
 
 
+def schedule_transfers(file_set, file_meta, order=None):
+    '''
+    Order the files to be transferred by their size.
+    Args:
+        file_set: File name set
+        file_meta: A dict for file name to it's other information,
+            ex: {'file_name': {'bytes': 1024}}
+        order: `ORDER_SMALLEST` to transfer small files first,
+            `ORDER_LARGEST` to transfer large files first,
+            else keep the original order
+    Returns:
+        files: Ordered file name list
+    '''
+    files = list(file_set)
+    if order not in (ORDER_SMALLEST, ORDER_LARGEST):
+        return files
+    files.sort(
+        key=lambda name: file_meta.get(name, {}).get('bytes', 0),
+        reverse=(order == ORDER_LARGEST)
+    )
+    return files
+
+
+class Throttle(object):
+    '''
+    Limit the transfer rate of one direction, ex: upload or download.
+    It can be shared by threads, then the limit is for all of them.
+    '''
+    def __init__(self, limit=0):
+        '''
+        Args:
+            limit: Max bytes per second, 0 means no limit
+        '''
+        self.limit = limit
+
+        self._lock = threading.Lock()
+        self._allowance = 0.0
+        self._last_time = time.time()
+
+    def consume(self, size):
+        '''
+        Account `size` bytes to the transfers,
+        sleep if they are faster than the limit
+        Args:
+            size: The bytes transferred
+        '''
+        if self.limit <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            # Unused bandwidth is kept for at most one chunk,
+            # so being idle for a while does not allow a burst
+            self._allowance = min(
+                self._allowance + (now - self._last_time) * self.limit,
+                CHUNK_SIZE
+            )
+            self._last_time = now
+            self._allowance -= size
+            delay = -self._allowance / self.limit
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TransferStats(object):
+    '''
+    Bytes and time of the transfers of one direction
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total_bytes = 0
+        self.total_time = 0.0
+
+    def add(self, size, seconds):
+        '''
+        Args:
+            size: The bytes of a finished transfer
+            seconds: The time the transfer took
+        '''
+        self.total_bytes += size
+        self.total_time += seconds
+
+    def rate(self):
+        '''
+        Returns:
+            rate: Achieved bytes per second of all finished transfers
+        '''
+        if self.total_time <= 0:
+            return 0.0
+        return self.total_bytes / self.total_time
+
+
+class ThrottledReader(object):
+    '''
+    File-like request body, which is read at the rate of a `Throttle`
+    while it is being sent
+    '''
+    def __init__(self, data, throttle):
+        '''
+        Args:
+            data: The request body string
+            throttle: Throttle instance
+        '''
+        self._file = StringIO(data)
+        self._len = len(data)
+        self.throttle = throttle
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        chunk = self._file.read(size)
+        self.throttle.consume(len(chunk))
+        return chunk
+
+
+def link_file(from_path, to_path):
+    '''
+    Hard link `from_path` to `to_path`, copy if can not link
+    '''
+    try:
+        os.link(from_path, to_path)
+    except (AttributeError, OSError):
+        shutil.copyfile(from_path, to_path)
+
+
+class Cache(object):
+    '''
+    Content cache of Dropbox files, keyed by the account, path and rev.
+    Files are evicted least recently used first when the cache is full.
+    '''
+    def __init__(self, cache_dir=CACHE_DIR, size_limit=CACHE_SIZE_LIMIT):
+        '''
+        Args:
+            cache_dir: The directory of cached files
+            size_limit: Max bytes of the cached files
+        '''
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._lock = threading.Lock()
+        # Cached file path to size, least recently used first
+        self._files = OrderedDict()
+        self._total_size = 0
+        self._scan_time = 0
+        self._scan()
+
+    def _get_file_path(self, account, path, rev):
+        key = ':'.join([account, path, rev])
+        key = md5.new(key.encode('utf-8')).hexdigest()
+        return self.cache_dir + os.sep + key
+
+    def get(self, account, path, rev):
+        '''
+        Args:
+            account: Dropbox account, ex: the app token
+            path: Dropbox file path
+            rev: Dropbox file rev
+        Returns:
+            file_path: The cached file path, None if not cached
+        '''
+        file_path = self._get_file_path(account, path, rev)
+        with self._lock:
+            try:
+                os.utime(file_path, None)  # Mark as recently used
+                size = self._files.pop(file_path, None)
+                if size is None:  # Added by another process
+                    size = os.path.getsize(file_path)
+                    self._total_size += size
+            except OSError:  # Not cached, or evicted by another worker
+                self._forget(file_path)
+                return None
+            self._files[file_path] = size
+        return file_path
+
+    def get_tmp_path(self):
+        '''
+        Returns:
+            tmp_path: A new temporary file path in the cache directory,
+                used to download a file before `add` it
+        '''
+        fd, tmp_path = tempfile.mkstemp(prefix='.', dir=self.cache_dir)
+        os.close(fd)
+        return tmp_path
+
+    def add(self, account, path, rev, tmp_path):
+        '''
+        Move the downloaded file into the cache
+        Args:
+            account: Dropbox account, ex: the app token
+            path: Dropbox file path
+            rev: Dropbox file rev
+            tmp_path: The downloaded file path, from `get_tmp_path`
+        Returns:
+            file_path: The cached file path, None if the file is larger
+                than the size limit, then `tmp_path` is left as it is
+        '''
+        size = os.path.getsize(tmp_path)
+        if size > self.size_limit:
+            logger.debug('Too large to cache: ' + path)
+            return None
+        file_path = self._get_file_path(account, path, rev)
+        with self._lock:
+            # The index misses files added by other processes,
+            # so check the directory before evicting and once in a while
+            if (self._total_size + size > self.size_limit or
+                    time.time() - self._scan_time > CACHE_SCAN_INTERVAL):
+                self._scan()
+            self._evict(size)
+            os.rename(tmp_path, file_path)
+            self._forget(file_path)  # Replaced
+            self._files[file_path] = size
+            self._total_size += size
+        return file_path
+
+    def evict(self, reserve=0):
+        '''
+        Remove the least recently used files until
+        there are `reserve` bytes free under the size limit
+        Args:
+            reserve: Bytes needed for a new file
+        '''
+        with self._lock:
+            self._scan()
+            self._evict(reserve)
+
+    def _evict(self, reserve):
+        while self._files and self._total_size + reserve > self.size_limit:
+            file_path, size = self._files.popitem(last=False)
+            self._total_size -= size
+            logger.debug('Cache evict: ' + file_path)
+            try:
+                os.remove(file_path)
+            except OSError:  # Evicted by another worker
+                pass
+
+    def _forget(self, file_path):
+        size = self._files.pop(file_path, None)
+        if size is not None:
+            self._total_size -= size
+
+    def _scan(self):
+        '''
+        Rebuild the index from the cache directory.
+        Temporary files left by killed downloads are removed as well.
+        '''
+        files = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            file_path = self.cache_dir + os.sep + name
+            try:
+                stat = os.stat(file_path)
+            except OSError:  # Evicted by another worker
+                continue
+            if name.startswith('.'):  # Downloading
+                if now - stat.st_mtime > CACHE_TMP_AGE:
+                    logger.debug('Cache remove stale: ' + file_path)
+                    try:
+                        os.remove(file_path)
+                    except OSError:
+                        pass
+                continue
+            files.append((stat.st_mtime, file_path, stat.st_size))
+        files.sort()
+        self._files = OrderedDict(
+            (file_path, size) for mtime, file_path, size in files
+        )
+        self._total_size = sum(self._files.values())
+        self._scan_time = now
+
+
 class UploadError(Exception):
     '''
     Upload Exception
@@ -99,12 +392,23 @@ class UploadError(Exception):
 
 class PhoSync(object):
 
-    def __init__(self, dropbox, flickr=None, gplus=None):
+    def __init__(self, dropbox, flickr=None, gplus=None, order=None):
+        '''
+        Args:
+            dropbox: Dropbox instance
+            flickr: Flickr instance
+            gplus: Google+ instance
+            order: Transfer order, see `schedule_transfers`
+        '''
         self.dropbox = dropbox
         self.flickr = flickr
         self.gplus = gplus
+        self.order = order
 
     def sync_flickr(self):
+        # Clients are reused by `serve`, count this sync only
+        self.dropbox.stats.reset()
+        self.flickr.stats.reset()
         dropbox_file_names, dropbox_file_metas = self.dropbox.ls()
         flickr_photoset_titles, flickr_photoset_metas = self.flickr.get_photosets_info()
         diff_set, base_set = self.diff_flickr(
@@ -121,26 +425,53 @@ class PhoSync(object):
                 s_flickr_photoset_titles
             )
             photoset_id = flickr_photoset_metas[folder]['id']
-            self._sync_flickr_leaf(folder, photoset_id, s_diff_set)
+            self._sync_flickr_leaf(
+                folder,
+                photoset_id,
+                s_diff_set,
+                s_dropbox_file_metas
+            )
+        self._log_transfer_rate()
+
+    def _log_transfer_rate(self):
+        logger.info(
+            'Dropbox download: {b} bytes, {r:.0f} bytes/sec'.format(
+                b=self.dropbox.stats.total_bytes,
+                r=self.dropbox.stats.rate()
+            )
+        )
+        logger.info(
+            'Flickr upload: {b} bytes, {r:.0f} bytes/sec'.format(
+                b=self.flickr.stats.total_bytes,
+                r=self.flickr.stats.rate()
+            )
+        )
 
     def _sync_flickr_root(self, folder):
-        file_set = self.dropbox.download_folder(folder)
+        file_set, file_meta = self.dropbox.ls(folder)
+        file_set = schedule_transfers(file_set, file_meta, self.order)
+        file_set = self.dropbox.download_folder(folder, file_set, file_meta)
         logger.debug('dropbox download at root: ' + str(file_set))
         flickr_photo_ids = []
         for f in file_set:
-            photo_id = self.flickr.upload_photo(folder, f)
+            photo_id = self.flickr.upload_photo(
+                self.dropbox.tmp_dir + os.sep + folder + os.sep + f
+            )
             flickr_photo_ids.append(photo_id)
         if flickr_photo_ids:  # Not a empty folder
             photoset_id = self.flickr.create_photoset(folder, flickr_photo_ids[0])
             for photo_id in flickr_photo_ids[1:]:
                 self.flickr.add_photo_to_photoset(photoset_id, photo_id)
 
-    def _sync_flickr_leaf(self, folder, photoset_id, file_set):
-        file_set = self.dropbox.download_folder(folder, file_set)
+    def _sync_flickr_leaf(self, folder, photoset_id, file_set, file_meta):
+        file_set = schedule_transfers(file_set, file_meta, self.order)
+        file_set = self.dropbox.download_folder(folder, file_set, file_meta)
         logger.debug('dropbox download at leaf: ' + str(file_set))
         photo_ids = []
         for f in file_set:
-            photo_id = self.flickr.upload_photo(folder, f)
+            photo_id = self.flickr.upload_photo(
+                self.dropbox.tmp_dir + os.sep + folder + os.sep + f
+            )
             photo_ids.append(photo_id)
         for photo_id in photo_ids:
             self.flickr.add_photo_to_photoset(photoset_id, photo_id)
@@ -170,7 +501,8 @@ class PhoSync(object):
 
 class Dropbox(object):
     def __init__(
-        self, api_key, api_secret, app_token, photo_path
+        self, api_key, api_secret, app_token, photo_path, throttle=None,
+        cache=None, tmp_name=None
     ):
         '''
         Args:
@@ -178,29 +510,39 @@ class Dropbox(object):
             api_secret: API secret string
             app_token: User auth token
             photo_path: Photo path of Dropbox
+            throttle: Download Throttle instance, None means no limit
+            cache: Cache instance, None means no cache
+            tmp_name: Sub directory name of the tmp dir, used to keep
+                profiles sharing the Dropbox account apart
         '''
         self.api_token = api_key
         self.api_secret = api_secret
         self.app_token = app_token
         self.photo_path = photo_path
+        self.throttle = throttle or Throttle()
+        self.stats = TransferStats()
+        self.cache = cache
 
         self.api_client = client.DropboxClient(app_token)
 
-        global TMP_DIR
-        TMP_DIR = (tempfile.gettempdir() + os.sep +
-                   'phosync' + os.sep + app_token)
+        self.tmp_dir = (tempfile.gettempdir() + os.sep +
+                        'phosync' + os.sep + app_token)
+        if tmp_name is not None:
+            self.tmp_dir += os.sep + tmp_name
         self._create_tmp_dir()
 
     def _create_tmp_dir(self):
         '''
         Create tmp dir recursively, exit if fail
         '''
-        if os.path.exists(TMP_DIR):
-            if not os.path.isdir(TMP_DIR):
-                logger.error('{path} is not a directory'.format(path=TMP_DIR))
+        if os.path.exists(self.tmp_dir):
+            if not os.path.isdir(self.tmp_dir):
+                logger.error(
+                    '{path} is not a directory'.format(path=self.tmp_dir)
+                )
                 sys.exit(1)
         else:
-            os.makedirs(TMP_DIR)
+            os.makedirs(self.tmp_dir)
 
     def ls(self, path=''):
         '''
@@ -213,7 +555,8 @@ class Dropbox(object):
         Returns:
             file_set: Dropbox file set
             file_meta: A dict for dropbox file name to it's other information,
-                ex: {'file_name': {'id':'aaaaaa', 'is_dir: False}}
+                ex: {'file_name': {'is_dir: False, 'bytes': 1024,
+                    'rev': '35e97029684fe'}}
         '''
         resp = self.api_client.metadata(
             self.photo_path + os.sep + path
@@ -229,54 +572,119 @@ class Dropbox(object):
                 file_set.add(name)
                 file_meta[name] = {
                     'is_dir': f['is_dir'],
+                    'bytes': f['bytes'],
+                    'rev': f.get('rev'),
                 }
         return file_set, file_meta
 
-    def download_file(self, from_path, to_path):
+    def download_file(self, from_path, to_path, rev=None):
         '''
         Copy file, metadata from Dropbox to local file, ex:
             from_path='Photo/test/test.jpg', to_path='/tmp/test/test.jpg'
+        If `rev` is given, the file is reused from the cache when possible
         Args:
             from_path: The file path under `photo_path`
             to_path: The file path where to be saved
+            rev: The Dropbox rev of the file
         '''
-        to_file = open(os.path.expanduser(to_path), 'wb')
-        logger.debug('Tmp image path: ' + os.path.expanduser(to_path))
-
+        to_path = os.path.expanduser(to_path)
+        logger.debug('Tmp image path: ' + to_path)
+        dropbox_path = self.photo_path + os.sep + from_path
+        if self.cache is None or rev is None:
+            self._fetch_file(dropbox_path, to_path)
+            return
+
+        cache_path = self.cache.get(self.app_token, dropbox_path, rev)
+        if cache_path is None:
+            tmp_path = self.cache.get_tmp_path()
+            try:
+                self._fetch_file(dropbox_path, tmp_path, rev)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            cache_path = self.cache.add(
+                self.app_token, dropbox_path, rev, tmp_path
+            )
+            if cache_path is None:
+                shutil.move(tmp_path, to_path)
+                return
+        else:
+            logger.debug('Cache hit: ' + dropbox_path)
+        try:
+            link_file(cache_path, to_path)
+        except (IOError, OSError):  # Evicted by another worker
+            logger.debug('Cache file gone: ' + dropbox_path)
+            self._fetch_file(dropbox_path, to_path, rev)
+
+    def _fetch_file(self, dropbox_path, to_path, rev=None):
+        # Fetch the exact rev, so the cached file matches its key
         f, metadata = self.api_client.get_file_and_metadata(
-            self.photo_path + os.sep + from_path
+            dropbox_path,
+            rev=rev
         )
         # print 'Metadata:', metadata
-        to_file.write(f.read())
-
-    def download_folder(self, from_path, file_set=None):
+        size = 0
+        begin_time = time.time()
+        with open(to_path, 'wb') as to_file:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                to_file.write(chunk)
+                self.throttle.consume(len(chunk))
+                size += len(chunk)
+        self.stats.add(size, time.time() - begin_time)
+
+    def download_folder(self, from_path, file_set=None, file_meta=None):
         '''
         Download a whole folder.
-        If `file_set` is not None, then only download the files in the set
+        If `file_set` is not None, then only download the files in the set,
+        files are downloaded in the iteration order of `file_set`
         Args:
             from_path: The file path under `photo_path`
             file_set: If is None, download whole folder,
                 else only download files in the file_set
+            file_meta: The metadata of `file_set` from `ls`,
+                the file revs in it are used to look up the cache
         Returns:
             file_set: The downloaded files
         '''
         if file_set is None:
             file_set, file_meta = self.ls(from_path)
-        to_path = TMP_DIR + os.sep + from_path
+        elif file_meta is None:
+            file_meta = {}
+        to_path = self.tmp_dir + os.sep + from_path
         if os.path.exists(to_path):
             shutil.rmtree(to_path)
         os.makedirs(to_path)
         for f in file_set:
-            self.download_file(from_path + os.sep + f, to_path + os.sep + f)
+            self.download_file(
+                from_path + os.sep + f,
+                to_path + os.sep + f,
+                file_meta.get(f, {}).get('rev')
+            )
         return file_set
 
 
 class Flickr(object):
-    def __init__(self, api_key, api_secret, app_token, app_secret):
+    def __init__(
+        self, api_key, api_secret, app_token, app_secret, throttle=None
+    ):
+        '''
+        Args:
+            api_key: API key string
+            api_secret: API secret string
+            app_token: User auth token
+            app_secret: User auth secret
+            throttle: Upload Throttle instance, None means no limit
+        '''
         self.api_key = api_key
         self.api_secret = api_secret
         self.app_token = app_token
         self.app_secret = app_secret
+        self.throttle = throttle or Throttle()
+        self.stats = TransferStats()
+        self.session = requests.Session()  # Keep connections alive
         self.rest_url = 'http://flickr.com/services/rest/'
         self.upload_url = 'http://up.flickr.com/services/upload/'
 
@@ -334,7 +742,7 @@ class Flickr(object):
         args = self._get_request_args(
             method='flickr.photosets.getList'
         )
-        resp = requests.post(self.rest_url, data=args)
+        resp = self.session.post(self.rest_url, data=args)
         logger.debug('Flickr photoset resp: ' + resp.text)
         resp_json = json.loads(resp.text.encode('utf-8'))
         photosets = resp_json['photosets']['photoset']
@@ -365,7 +773,7 @@ class Flickr(object):
             method='flickr.photosets.getPhotos',
             photoset_id=photoset_id
         )
-        resp = requests.post(self.rest_url, data=args)
+        resp = self.session.post(self.rest_url, data=args)
         logger.debug('Flickr photo resp: ' + resp.text)
         resp_json = json.loads(resp.text.encode('utf-8'))
         photos = resp_json['photoset']['photo']
@@ -379,7 +787,15 @@ class Flickr(object):
         return photo_titles, photo_metas
 
     @retry()
-    def upload_photo(self, folder, photo_name):
+    def upload_photo(self, file_path):
+        '''
+        Upload a local photo, the file name is used as the title
+        Args:
+            file_path: The local photo path
+        Returns:
+            photo_id: The id of the photo uploaded
+        '''
+        photo_name = os.path.basename(file_path)
         args = [
             ('api_key', self.api_key),
             ('auth_token', self.app_token),
@@ -392,12 +808,17 @@ class Flickr(object):
         api_sig = self._get_api_sig(args)
         args.append(api_sig)
 
-        file_path = TMP_DIR + os.sep + folder + os.sep + photo_name
         logger.debug('Flicrk upload image: ' + file_path)
-        files = {
-            'photo': open(file_path, 'rb'),
-        }
-        resp = requests.post(self.upload_url, data=args, files=files)
+        with open(file_path, 'rb') as f:
+            args.append(('photo', (photo_name, f.read())))
+        body, content_type = encode_multipart_formdata(args)
+        begin_time = time.time()
+        resp = self.session.post(
+            self.upload_url,
+            data=ThrottledReader(body, self.throttle),
+            headers={'Content-Type': content_type}
+        )
+        self.stats.add(len(body), time.time() - begin_time)
         logger.debug('Flickr upload response: ' + resp.text)
         resp_xml = minidom.parseString(resp.text)
         rsp = resp_xml.getElementsByTagName('rsp')[0]
@@ -434,7 +855,7 @@ class Flickr(object):
             title=photoset_name,
             primary_photo_id=primary_photo_id
         )
-        resp = requests.post(self.rest_url, data=args)
+        resp = self.session.post(self.rest_url, data=args)
         logger.debug('Flickr create photoset resp: ' + resp.text)
         resp_json = json.loads(resp.text)
         photoset_id = resp_json['photoset']['id']
@@ -452,10 +873,127 @@ class Flickr(object):
             photoset_id=photoset_id,
             photo_id=photo_id
         )
-        resp = requests.post(self.rest_url, data=args)
+        resp = self.session.post(self.rest_url, data=args)
         logger.debug(resp.text)
 
 
+class Profile(object):
+    '''
+    A Dropbox and Flickr account pair loaded from a config file,
+    the clients are kept for every sync of the profile
+    '''
+    def __init__(
+        self, conf_file, download_throttle=None, upload_throttle=None
+    ):
+        '''
+        Args:
+            conf_file: The config file path, ex: phosync.conf
+            download_throttle: Throttle shared by the profiles' downloads
+            upload_throttle: Throttle shared by the profiles' uploads
+        '''
+        self.conf_file = conf_file
+        self.phosync = init_phosync(
+            functools.partial(ConfigReader, conf_file),
+            download_throttle,
+            upload_throttle
+        )
+        self.next_run = 0
+        self.running = False
+
+    def sync(self):
+        self.phosync.sync_flickr()
+
+
+class Server(object):
+    '''
+    Sync profiles periodically on a shared pool of worker threads
+    '''
+    def __init__(
+        self, profiles=None, interval=3600, workers=4,
+        download_limit=0, upload_limit=0
+    ):
+        '''
+        Args:
+            profiles: Profile list
+            interval: Seconds between two syncs of a profile
+            workers: Number of worker threads
+            download_limit: Max download bytes per second of all profiles,
+                0 means no limit
+            upload_limit: Max upload bytes per second of all profiles,
+                0 means no limit
+        '''
+        self.profiles = profiles or []
+        self.interval = interval
+        self.workers = workers
+        self.download_throttle = Throttle(download_limit)
+        self.upload_throttle = Throttle(upload_limit)
+
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+
+    def add_profile(self, conf_file):
+        '''
+        Load a profile which shares the throttles of the server
+        Args:
+            conf_file: The config file path, ex: phosync.conf
+        '''
+        profile = Profile(
+            conf_file,
+            self.download_throttle,
+            self.upload_throttle
+        )
+        self.profiles.append(profile)
+        return profile
+
+    def schedule(self, now):
+        '''
+        Queue the profiles which are due, the longest waiting one first.
+        A profile is not queued again until its sync is done,
+        so every profile gets a fair share of the workers.
+        Args:
+            now: Current timestamp
+        Returns:
+            due: The profiles queued
+        '''
+        with self._lock:
+            due = [
+                p for p in self.profiles
+                if not p.running and p.next_run <= now
+            ]
+            due.sort(key=lambda p: p.next_run)
+            for profile in due:
+                profile.running = True
+                self._queue.put(profile)
+        return due
+
+    def _work(self):
+        while True:
+            profile = self._queue.get()
+            if profile is None:  # Stop the worker
+                self._queue.task_done()
+                break
+            logger.info('Sync start: ' + profile.conf_file)
+            try:
+                profile.sync()
+            except (Exception, SystemExit):  # `retry` exits when giving up
+                logger.exception('Sync failed: ' + profile.conf_file)
+            else:
+                logger.info('Sync done: ' + profile.conf_file)
+            with self._lock:
+                profile.running = False
+                profile.next_run = time.time() + self.interval
+            self._queue.task_done()
+
+    def serve_forever(self, poll_interval=1):
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+        while True:
+            self.schedule(time.time())
+            time.sleep(poll_interval)
+
+
 def init_logger():
     formatter = logging.Formatter('%(levelname)s: %(message)s')
     console = logging.StreamHandler(stream=sys.stdout)
@@ -503,54 +1041,138 @@ def _parse_cli_args():
         help='Flick photoset, sync all if empty',
         metavar='<flickr photoset>'
     )
+    serve_parser = subparser.add_parser('serve')
+    serve_parser.set_defaults(which='serve')
+    serve_parser.add_argument(
+        'conf',
+        nargs='*',
+        default=[CONF_FILE],
+        help='Config files of the profiles, default is ' + CONF_FILE,
+        metavar='<config file>'
+    )
+    serve_parser.add_argument(
+        '-i',
+        type=int,
+        default=3600,
+        help='Seconds between two syncs of a profile',
+        metavar='<seconds>'
+    )
+    serve_parser.add_argument(
+        '-w',
+        type=int,
+        default=4,
+        help='Number of worker threads',
+        metavar='<workers>'
+    )
+    serve_parser.add_argument(
+        '-D',
+        type=int,
+        default=None,
+        help='Max download bytes per second of all profiles, '
+             'default is DOWNLOAD_LIMIT of the first config file',
+        metavar='<bytes/sec>'
+    )
+    serve_parser.add_argument(
+        '-U',
+        type=int,
+        default=None,
+        help='Max upload bytes per second of all profiles, '
+             'default is UPLOAD_LIMIT of the first config file',
+        metavar='<bytes/sec>'
+    )
     args = parser.parse_args()
     logger.debug(args)
     return args
 
 
 class ConfigReader(object):
-    def __init__(self):
+    def __init__(self, conf_file=CONF_FILE):
         self._parser = SafeConfigParser()
-        self._parser.read(CONF_FILE)
+        self._parser.read(conf_file)
 
-    def read(self, service_name, key):
+    def read(self, service_name, key, default=None):
+        '''
+        Args:
+            service_name: The section name, ex: dropbox
+            key: The option name, ex: APP_KEY
+            default: Returned if the option is not set,
+                raise if it is None
+        '''
+        if (default is not None and
+                not self._parser.has_option(service_name, key)):
+            return default
         return self._parser.get(service_name, key)
 
 
-def init_dropbox(reader_class):
+def init_dropbox(reader_class, tmp_name=None, throttle=None):
     reader = reader_class()
     dropbox_api_key = reader.read('dropbox', 'APP_KEY')
     dropbox_api_secret = reader.read('dropbox', 'APP_SECRET')
 
     dropbox_app_token = reader.read('dropbox', 'APP_TOKEN')
     dropbox_photo_path = reader.read('dropbox', 'CURRENT_PATH')
+    if throttle is None:
+        throttle = Throttle(
+            int(reader.read('transfer', 'DOWNLOAD_LIMIT', '0'))
+        )
+
+    cache_dir = reader.read('cache', 'DIR', CACHE_DIR)
+    cache_size_limit = int(
+        reader.read('cache', 'SIZE_LIMIT', str(CACHE_SIZE_LIMIT))
+    )
+    cache = None
+    if cache_size_limit > 0:
+        cache = Cache(os.path.expanduser(cache_dir), cache_size_limit)
 
     dropbox = Dropbox(
         dropbox_api_key,
         dropbox_api_secret,
         dropbox_app_token,
-        dropbox_photo_path
+        dropbox_photo_path,
+        throttle,
+        cache,
+        tmp_name
     )
     return dropbox
 
 
-def init_flickr(reader_class):
+def init_flickr(reader_class, throttle=None):
     reader = reader_class()
     flickr_api_key = reader.read('flickr', 'API_KEY')
     flickr_api_secret = reader.read('flickr', 'API_SECRET')
 
     flickr_app_token = reader.read('flickr', 'APP_TOKEN')
     flickr_app_secret = reader.read('flickr', 'APP_SECRET')
+    if throttle is None:
+        throttle = Throttle(int(reader.read('transfer', 'UPLOAD_LIMIT', '0')))
 
     flickr = Flickr(
         flickr_api_key,
         flickr_api_secret,
         flickr_app_token,
-        flickr_app_secret
+        flickr_app_secret,
+        throttle
     )
     return flickr
 
 
+def init_phosync(reader_class, download_throttle=None, upload_throttle=None):
+    flickr = init_flickr(reader_class, upload_throttle)
+    # Profiles may share the Dropbox account but not the Flickr one
+    dropbox = init_dropbox(reader_class, flickr.app_token, download_throttle)
+    order = reader_class().read('transfer', 'ORDER', '')
+    if order not in ('', ORDER_SMALLEST, ORDER_LARGEST):
+        logger.error(
+            'Unknown transfer order: {order}, should be {a} or {b}'.format(
+                order=order,
+                a=ORDER_SMALLEST,
+                b=ORDER_LARGEST
+            )
+        )
+        sys.exit(1)
+    return PhoSync(dropbox, flickr, order=order)
+
+
 def ls_command(args):
     if args.d is not None:
         dropbox = init_dropbox(ConfigReader)
@@ -567,12 +1189,30 @@ def ls_command(args):
 
 def sync_command(args):
     if args.d is not None and args.f is not None:
-        dropbox = init_dropbox(ConfigReader)
-        flickr = init_flickr(ConfigReader)
-        phosync = PhoSync(dropbox, flickr)
+        phosync = init_phosync(ConfigReader)
         phosync.sync_flickr()
 
 
+def serve_command(args):
+    reader = ConfigReader(args.conf[0])
+    download_limit = args.D
+    if download_limit is None:
+        download_limit = int(reader.read('transfer', 'DOWNLOAD_LIMIT', '0'))
+    upload_limit = args.U
+    if upload_limit is None:
+        upload_limit = int(reader.read('transfer', 'UPLOAD_LIMIT', '0'))
+
+    server = Server(
+        interval=args.i,
+        workers=args.w,
+        download_limit=download_limit,
+        upload_limit=upload_limit
+    )
+    for conf_file in args.conf:
+        server.add_profile(conf_file)
+    server.serve_forever()
+
+
 def main():
     init_logger()
     args = _parse_cli_args()
@@ -580,6 +1220,8 @@ def main():
         ls_command(args)
     elif args.which == 'sync':
         sync_command(args)
+    elif args.which == 'serve':
+        serve_command(args)
     # flickr.create_photoset('test', '4837317332')
     # cacasync = CaCaSync(dropbox, flickr)
     # cacasync.sync_flickr()
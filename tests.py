@@ -65,6 +65,247 @@ def test_legal_image():
             for k in mime_list[i[1]]:
                 yield check_legal_image, i, j, k
 
+
+def test_schedule_transfers():
+    from phosync import schedule_transfers, ORDER_SMALLEST, ORDER_LARGEST
+    file_set = set(['a.jpg', 'b.jpg', 'c.jpg'])
+    file_meta = {
+        'a.jpg': {'bytes': 20},
+        'b.jpg': {'bytes': 10},
+        'c.jpg': {'bytes': 30},
+    }
+    assert schedule_transfers(
+        file_set, file_meta, ORDER_SMALLEST
+    ) == ['b.jpg', 'a.jpg', 'c.jpg']
+    assert schedule_transfers(
+        file_set, file_meta, ORDER_LARGEST
+    ) == ['c.jpg', 'a.jpg', 'b.jpg']
+    assert sorted(schedule_transfers(file_set, file_meta)) == sorted(file_set)
+
+
+def test_throttle():
+    import time
+    import threading
+    from phosync import Throttle
+    throttle = Throttle(1000)
+    start = time.time()
+    throttle.consume(100)
+    assert time.time() - start >= 0.09
+
+    # The limit is shared by all threads
+    throttle = Throttle(1000)
+    threads = [
+        threading.Thread(target=throttle.consume, args=(100,))
+        for i in range(3)
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.time() - start >= 0.29
+
+    throttle = Throttle()
+    start = time.time()
+    throttle.consume(100)
+    assert time.time() - start < 0.05
+
+
+def test_transfer_stats():
+    from phosync import TransferStats
+    stats = TransferStats()
+    assert stats.rate() == 0.0
+    stats.add(100, 0.5)
+    stats.add(100, 1.5)
+    assert stats.total_bytes == 200
+    assert stats.rate() == 100.0
+    stats.reset()
+    assert stats.total_bytes == 0
+    assert stats.rate() == 0.0
+
+
+def test_cache():
+    import os
+    import shutil
+    import tempfile
+    from phosync import Cache
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = Cache(cache_dir, 20)
+        assert cache.get('token', '/Photos/a.jpg', '1') is None
+
+        for name, mtime in (('a.jpg', 1), ('b.jpg', 2)):
+            tmp_path = cache.get_tmp_path()
+            with open(tmp_path, 'wb') as f:
+                f.write('x' * 10)
+            file_path = cache.add('token', '/Photos/' + name, '1', tmp_path)
+            os.utime(file_path, (mtime, mtime))
+        assert cache.get('token', '/Photos/a.jpg', '1') is not None
+        assert cache.get('token', '/Photos/a.jpg', '2') is None
+        # Same path and rev of another Dropbox account
+        assert cache.get('other', '/Photos/a.jpg', '1') is None
+
+        # b.jpg is the least recently used one after getting a.jpg
+        tmp_path = cache.get_tmp_path()
+        with open(tmp_path, 'wb') as f:
+            f.write('x' * 10)
+        cache.add('token', '/Photos/c.jpg', '1', tmp_path)
+        assert cache.get('token', '/Photos/a.jpg', '1') is not None
+        assert cache.get('token', '/Photos/b.jpg', '1') is None
+        assert cache.get('token', '/Photos/c.jpg', '1') is not None
+
+        # Evicted by another worker
+        os.remove(cache.get('token', '/Photos/c.jpg', '1'))
+        assert cache.get('token', '/Photos/c.jpg', '1') is None
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_cache_index():
+    import shutil
+    import tempfile
+    from phosync import Cache
+
+    def add(cache, account, name):
+        tmp_path = cache.get_tmp_path()
+        with open(tmp_path, 'wb') as f:
+            f.write('x' * 10)
+        return cache.add(account, '/Photos/' + name, '1', tmp_path)
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = Cache(cache_dir, 25)
+        other = Cache(cache_dir, 25)  # Another process
+        scans = []
+        scan = cache._scan
+        cache._scan = lambda: scans.append(1) or scan()
+
+        # No directory scan while the index is under the limit
+        add(cache, 'token', 'a.jpg')
+        add(cache, 'token', 'b.jpg')
+        assert scans == []
+
+        # Found by the scan once the index reaches the limit
+        add(other, 'other', 'c.jpg')
+        add(cache, 'token', 'd.jpg')
+        assert scans == [1]
+        assert cache.get('token', '/Photos/a.jpg', '1') is None
+        assert other.get('other', '/Photos/c.jpg', '1') is not None
+        assert cache.get('token', '/Photos/d.jpg', '1') is not None
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_cache_too_large():
+    import os
+    import shutil
+    import tempfile
+    from phosync import Cache
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = Cache(cache_dir, 5)
+        tmp_path = cache.get_tmp_path()
+        with open(tmp_path, 'wb') as f:
+            f.write('x' * 10)
+        assert cache.add('token', '/Photos/a.jpg', '1', tmp_path) is None
+        assert cache.get('token', '/Photos/a.jpg', '1') is None
+        assert os.path.exists(tmp_path)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_cache_stale_tmp():
+    import os
+    import shutil
+    import tempfile
+    from phosync import Cache, CACHE_TMP_AGE
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = Cache(cache_dir, 20)
+        stale_path = cache.get_tmp_path()
+        mtime = os.path.getmtime(stale_path) - CACHE_TMP_AGE - 1
+        os.utime(stale_path, (mtime, mtime))
+        tmp_path = cache.get_tmp_path()
+        cache.evict()
+        assert not os.path.exists(stale_path)
+        assert os.path.exists(tmp_path)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_throttled_reader():
+    import time
+    from phosync import Throttle, ThrottledReader
+    throttle = Throttle(1000)
+    reader = ThrottledReader('x' * 200, throttle)
+    assert len(reader) == 200
+    start = time.time()
+    # Paced while the body is read for sending, not after it
+    assert reader.read(100) == 'x' * 100
+    assert time.time() - start >= 0.09
+    assert ''.join(reader) == 'x' * 100
+    assert time.time() - start >= 0.19
+
+
+class FakeProfile(object):
+    def __init__(self, conf_file, next_run, error=None):
+        self.conf_file = conf_file
+        self.next_run = next_run
+        self.running = False
+        self.error = error
+        self.synced = 0
+
+    def sync(self):
+        self.synced += 1
+        if self.error is not None:
+            raise self.error
+
+
+def test_server_schedule():
+    from phosync import Server
+    a = FakeProfile('a.conf', 20)
+    b = FakeProfile('b.conf', 10)
+    c = FakeProfile('c.conf', 100)
+    server = Server([a, b, c])
+    assert server.schedule(50) == [b, a]
+    assert a.running and b.running and not c.running
+    # Running profiles are not queued twice
+    assert server.schedule(200) == [c]
+    assert server.schedule(300) == []
+
+
+def test_server_work():
+    import threading
+    import time
+    from phosync import Server
+    ok = FakeProfile('ok.conf', 0)
+    fail = FakeProfile('fail.conf', 0, ValueError('network'))
+    exit = FakeProfile('exit.conf', 0, SystemExit(1))
+    profiles = [ok, fail, exit]
+    server = Server(profiles, interval=60, workers=1)
+    worker = threading.Thread(target=server._work)
+    worker.daemon = True
+    worker.start()
+
+    start = time.time()
+    assert server.schedule(start) == profiles
+    server._queue.join()
+    for profile in profiles:
+        assert profile.synced == 1
+        assert not profile.running
+        assert profile.next_run >= start + 60
+
+    # Failed profiles are rescheduled and the worker is still alive
+    assert sorted(server.schedule(start + 120)) == sorted(profiles)
+    server._queue.join()
+    for profile in profiles:
+        assert profile.synced == 2
+        assert not profile.running
+
+    server._queue.put(None)
+    worker.join()
+
+
 # class PhoSyncTests(unittest.TestCase):
 #
 #     def test_legal_image_size(self):